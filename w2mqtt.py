@@ -4,68 +4,150 @@ import os
 import sys
 import time
 import json
+import math
 import smbus
 import signal
+import select
 import paho.mqtt.client as mqtt
 
 from os import path
+from collections import OrderedDict
 from time import sleep
-from queue import SimpleQueue
 from ctypes import c_short
-from threading import Thread
-from subprocess import check_output
 
 
 VERSION = "0.0.2"
 
+# The Atlas splits a reading over message types 37, 38 and 39.  Each one sets
+#  a bit in Sensor.atlas_seen, and the reading is complete once all are set
+_ATLAS_TYPES = frozenset((37, 38, 39))
+_ATLAS_COMPLETE = 0b111
+
+# Neighbors' sensors come and go, so only remember this many unknown ids.
+#  One that gets dropped just gets announced on unknown/weather again
+_MAX_IGNORED = 4096
+
 class SensorList:
-    def __init__(self, sensorNames):
+    def __init__(self, sensorNames, baseTopic = ""):
         # Keep track of timestamp / id pairs.  Many of these sensors
         #  like to send things in tripilicate, and there isn't any reason
         #  to send that down the line
         self.lastMessage = {}
         self.sensors = {}
         self.sensorNames = sensorNames
+        self.baseTopic = baseTopic
 
     def process(self, data):
 
         # we need to know what this sensor is
-        if not 'id' in data:
+        sid = data.get('id')
+        if sid is None:
             return
 
         # check to see if this is a repeat message
-        if ( 'id' in data and 'time' in data and
-             data['id'] in self.lastMessage and
-             data['time'] == self.lastMessage[data['id']]):
+        ts = data.get('time')
+        if ts is not None and self.lastMessage.get(sid) == ts:
             # We already have a message from this sensor with this timestamp so let it go
             return
-        else:
-            # Keep track of this one
-            self.lastMessage[data['id']] = data['time']
-            
-        if not data['id'] in self.sensors:
-            # we haven't seen this sensor yet, so make a new one
-            name = ""
-            if data['id'] in self.sensorNames:
-                name = self.sensorNames[data['id']]
 
-            model = ""
-            if 'model' in data:
-                model = data['model']
+        # Keep track of this one
+        self.lastMessage[sid] = ts
 
-            self.sensors[data['id']] = Sensor(model, data['id'], name)
+        sensor = self.sensors.get(sid)
+        if sensor is None:
+            # we haven't seen this sensor yet, so make a new one
+            name = self.sensorNames.get(sid, "")
+            model = data.get('model', "")
+            sensor = Sensor(model, sid, name, self.baseTopic)
+            self.sensors[sid] = sensor
 
         # Then we just process the data like normal    
-        if self.sensors[data['id']].update(data):
-            yield self.sensors[data['id']]
+        if sensor.update(data):
+            yield sensor
         
+def _set_battery(sensor, val):
+    sensor.battery = (val == 1)
+
+def _set_rain(sensor, val):
+    # TODO: Look into what this reports and when
+    if sensor.last_rain < 0:
+        sensor.last_rain = val
+    sensor.rain = val
+
+def _add_wind(sensor, val):
+    sensor.wind_sum += val
+    sensor.wind_count += 1
+
+def _add_strikes(sensor, val):
+    sensor.strike_sum += val
+    sensor.strike_count += 1
+
+def _add_strike_dist(sensor, val):
+    sensor.dist_sum += val
+    sensor.dist_count += 1
+
+def _finite(val):
+    # NaN and Infinity aren't valid JSON, so send them as null instead
+    if isinstance(val, float) and not math.isfinite(val):
+        return None
+    return val
+
+# Map each rtl_433 json key we care about to how it updates a sensor
+_FIELD_SETTERS = {
+    'channel':         lambda s, v: setattr(s, 'channel', v),
+    'battery_ok':      _set_battery,
+    'temperature_C':   lambda s, v: setattr(s, 'temp', v),
+    'temperature_1_C': lambda s, v: setattr(s, 'ptemp', v),
+    'humidity':        lambda s, v: setattr(s, 'humidity', v),
+    'time':            lambda s, v: setattr(s, 'measure_time', v),
+    'rssi':            lambda s, v: setattr(s, 'rssi', v),
+    'snr':             lambda s, v: setattr(s, 'snr', v),
+    'noise':           lambda s, v: setattr(s, 'noise', v),
+    'wind_avg_mi_h':   _add_wind,
+    'wind_avg_km_h':   lambda s, v: _add_wind(s, v / 1.609344),
+    'wind_dir_deg':    lambda s, v: setattr(s, 'wind_dir', v),
+    'strike_count':    _add_strikes,
+    'strike_distance': _add_strike_dist,
+    'uv':              lambda s, v: setattr(s, 'uv', v),
+    'lux':             lambda s, v: setattr(s, 'lux', v),
+    'rain_in':         _set_rain,
+}
+
+# Fahrenheit readings have always won over Celsius ones when a message has
+#  both, so these get applied after everything else
+_LATE_SETTERS = (
+    ('temperature_F',   lambda s, v: setattr(s, 'temp', (v - 32.0) * (5.0 / 9.0))),
+    ('temperature_1_F', lambda s, v: setattr(s, 'ptemp', (v - 32.0) * (5.0 / 9.0))),
+)
+
 class Sensor:
+    # One of these per sensor id, and update/publish touch these a lot
+    __slots__ = ('model', 'myID', 'name', 'measure_time', 'temp', 'humidity',
+                 'battery', 'channel', 'ptemp', 'wind_sum', 'wind_count',
+                 'wind_dir', 'last_rain', 'rain', 'strike_sum', 'strike_count',
+                 'dist_sum', 'dist_count', 'uv', 'lux', 'atlas_seen', 'rssi',
+                 'noise', 'snr', '_topic_json', '_topic_temp_c', '_topic_temp_f',
+                 '_topic_humidity', '_topic_battery', '_topic_ptemp_c',
+                 '_topic_ptemp_f')
+
     # Create a sensor reading with a given model and id
-    def __init__(self, model, sID, name=""):
+    def __init__(self, model, sID, name="", baseTopic=""):
         self.model = model
         self.myID = sID
         self.name = name
 
+        # The topics never change for a sensor, so build them once here
+        tc = self.topic()
+        if len(baseTopic) > 0:
+            tc = baseTopic + "/" + tc
+        self._topic_json = tc
+        self._topic_temp_c = tc + "/temp_c"
+        self._topic_temp_f = tc + "/temp_f"
+        self._topic_humidity = tc + "/humidity"
+        self._topic_battery = tc + "/battery"
+        self._topic_ptemp_c = tc + "/ptemp_c"
+        self._topic_ptemp_f = tc + "/ptemp_f"
+
         # basic measurement information all sensors have
         self.measure_time = ""
         self.temp = 0
@@ -79,15 +161,20 @@ class Sensor:
         self.ptemp = 0
 
         # Atlas only information
-        self.wind_speed = []
+        #  wind speed, strikes and strike distance come in every message, so
+        #  keep a running sum and count to average them at publish time
+        self.wind_sum = 0.0
+        self.wind_count = 0
         self.wind_dir = 0
         self.last_rain = -1
         self.rain = 0
-        self.strikes = []
-        self.strike_dist = []
+        self.strike_sum = 0
+        self.strike_count = 0
+        self.dist_sum = 0
+        self.dist_count = 0
         self.uv = 0
         self.lux = 0
-        self.atlas_seen = {37:False, 38:False, 39:False}
+        self.atlas_seen = 0
 
         # Signal information
         self.rssi = 0
@@ -96,86 +183,34 @@ class Sensor:
         
     def update(self, jsonData):
         # Make sure this really is for us
-        if 'id' in jsonData and jsonData['id'] != self.myID:
+        sid = jsonData.get('id')
+        if sid is not None and sid != self.myID:
             return False
 
-        if 'channel' in jsonData:
-            self.channel = jsonData['channel']
-
-        if 'battery_ok' in jsonData:
-            if jsonData['battery_ok'] == 1:
-                self.battery = True
-            else:
-                self.battery = False
-        if 'temperature_C' in jsonData:
-            self.temp = jsonData['temperature_C']
-
-        if 'temperature_F' in jsonData:
-            self.temp = (jsonData['temperature_F'] - 32.0) * (5.0 / 9.0)
+        # Only visit the keys this message actually has
+        for key, val in jsonData.items():
+            setter = _FIELD_SETTERS.get(key)
+            if setter is not None:
+                setter(self, val)
 
-        if 'temperature_1_C' in jsonData:
-            self.ptemp = jsonData['temperature_1_C']
-
-        if 'temperature_1_F' in jsonData:
-            self.ptemp = (jsonData['temperature_1_F'] - 32.0) * (5.0 / 9.0)
-
-        if 'humidity' in jsonData:
-            self.humidity = jsonData['humidity']
-
-        if 'time' in jsonData:
-            self.measure_time = jsonData['time']
-
-        if 'rssi' in jsonData:
-            self.rssi = jsonData['rssi']
-
-        if 'snr' in jsonData:
-            self.snr = jsonData['snr']
-
-        if 'noise' in jsonData:
-            self.noise = jsonData['noise']
-
-        if 'wind_avg_mi_h' in jsonData:
-            self.wind_speed.append(jsonData['wind_avg_mi_h'])
-
-        if 'wind_avg_km_h' in jsonData:
-            self.wind_speed.append(jsonData['wind_avg_km_h'] / 1.609344)
-
-        if 'wind_dir_deg' in jsonData:
-            self.wind_dir = jsonData['wind_dir_deg']
-
-        if 'strike_count' in jsonData:
-            self.strikes.append(jsonData['strike_count'])
-
-        if 'strike_distance' in jsonData:
-            self.strike_dist.append(jsonData['strike_distance'])
-        
-        if 'uv' in jsonData:
-            self.uv = jsonData['uv']
-
-        if 'lux' in jsonData:
-            self.lux = jsonData['lux']
-
-        # TODO: Look into what this reports and when
-        if 'rain_in' in jsonData:
-            if self.last_rain < 0:
-                self.last_rain = jsonData['rain_in']
-            self.rain = jsonData['rain_in']
+        for key, setter in _LATE_SETTERS:
+            if key in jsonData:
+                setter(self, jsonData[key])
 
         if 'message_type' in jsonData:
             mt = jsonData['message_type']
-            if mt not in [37, 38, 39]:
+            # Only numbers can be one of ours (37.0 counts as 37), anything
+            #  else would not even hash
+            if isinstance(mt, (int, float)) and mt in _ATLAS_TYPES:
+                self.atlas_seen |= 1 << (int(mt) - 37)
+            else:
                 print(" ******** Strange message type: ")
                 print(jsonData)
-            else:
-                self.atlas_seen[mt] = True
 
         # We need all three message type to get a full atlas reading, so wait until 
         #  we see all three
         if self.model == 'Acurite-Atlas':
-            if self.atlas_seen[37] and self.atlas_seen[38] and self.atlas_seen[39]:
-                return True
-            else:
-                return False
+            return self.atlas_seen == _ATLAS_COMPLETE
 
         # Other sensors are complete in one reading
         return True
@@ -186,106 +221,122 @@ class Sensor:
         else:
             return self.name
 
-    def publishMQTTJSON(self, client, baseTopic = ""):
-        tc = self.topic()
-        if len(baseTopic) > 0:
-            tc = baseTopic + "/" + tc
-
-        pld = "{"
-        pld += "\"temp\": {val}, ".format(val=self.temp)
-            
-        pld += "\"hum\": {val}, ".format(val=self.humidity)
-            
-        if self.battery:
-            pld += "\"batt\": true, "
-        else:
-            pld += "\"batt\": false, "
+    # This is the default way to publish: the whole reading goes out as one
+    #  QoS 0 message, so there is a single publish and no broker ack per event
+    def publishMQTTJSON(self, client):
+        pld = {
+            'temp': self.temp,
+            'hum': self.humidity,
+            'batt': self.battery,
+        }
 
         if self.model == "Acurite-Tower":
             # this also has a channel
-            pld += "\"chan\": \"{val}\", ".format(val=self.channel)
+            pld['chan'] = self.channel
         elif self.model == "Acurite-00275rm":
             # Temperature probes
-            pld += "\"ptemp\": {val}, ".format(val=self.ptemp)
+            pld['ptemp'] = self.ptemp
         elif self.model == "Acurite-Atlas":
             # Whole bunch of stuff to do here...
-            pld += "\"chan\": \"{val}\", ".format(val=self.channel)
-            pld += "\"uv\": {val}, ".format(val=self.uv)
-            pld += "\"lux\": {val}, ".format(val=self.lux)
-            pld += "\"wind_dir\": {val}, ".format(val=self.wind_dir)
+            pld['chan'] = self.channel
+            pld['uv'] = self.uv
+            pld['lux'] = self.lux
+            pld['wind_dir'] = self.wind_dir
             # wind speed, strike count, and strike distance are in every message,
             #  so we will take the average of them
-            #if len(self.wind_speed) != 3 or len(self.strikes) != 3 or len(self.strike_dist) != 3:
+            #if self.wind_count != 3 or self.strike_count != 3 or self.dist_count != 3:
             #    print(" ******** we have more elements than expected")
-            #    print("{},{},{}".format(len(self.wind_speed), len(self.strikes), len(self.strike_dist)))
-            pld += "\"wind_speed\": {val}, ".format(val=sum(self.wind_speed) / len(self.wind_speed))
-            pld += "\"strikes\": {val}, ".format(val=sum(self.strikes) / len(self.strikes))
-            pld += "\"strike_dist\": {val}, ".format(val=sum(self.strike_dist) / len(self.strike_dist))
+            #    print("{},{},{}".format(self.wind_count, self.strike_count, self.dist_count))
+            pld['wind_speed'] = self.wind_sum / self.wind_count if self.wind_count else 0.0
+            pld['strikes'] = self.strike_sum / self.strike_count if self.strike_count else 0.0
+            pld['strike_dist'] = self.dist_sum / self.dist_count if self.dist_count else 0.0
             delta_rain = self.rain - self.last_rain
             if delta_rain < 0:
                 delta_rain = 0
-            pld += "\"rain_delta\": {val}, ".format(val=delta_rain)
-            pld += "\"rain\": {val}, ".format(val=self.rain)
+            pld['rain_delta'] = delta_rain
+            pld['rain'] = self.rain
             self.last_rain = self.rain
             # Then reset all our cumulative atlas measurements
-            self.wind_speed.clear()
-            self.strikes.clear()
-            self.strike_dist.clear()
-            self.atlas_seen = {37:False, 38:False, 39:False}
-
-        pld += "\"rssi\": {val}, ".format(val=self.rssi)
-        pld += "\"noise\": {val}, ".format(val=self.noise)
-
-        pld += "\"time\": \"{val}\"".format(val=self.measure_time)
-
-        pld += "}"
-
-        client.publish(tc, pld)
-
-    def publishMQTTIndividual(self, client, baseTopic = ""):
-        tc = self.topic()
-        if len(baseTopic) > 0:
-            tc = baseTopic + "/" + tc
-            
-        client.publish(tc + "/temp_c", self.temp)
-        client.publish(tc + "/temp_f", round((self.temp * (9.0/5.0)) + 32, 1))
+            self.wind_sum = 0.0
+            self.wind_count = 0
+            self.strike_sum = 0
+            self.strike_count = 0
+            self.dist_sum = 0
+            self.dist_count = 0
+            self.atlas_seen = 0
+
+        pld['rssi'] = self.rssi
+        pld['noise'] = self.noise
+        pld['time'] = self.measure_time
+
+        pld = {key: _finite(val) for key, val in pld.items()}
+        client.publish(self._topic_json,
+                       json.dumps(pld, separators=(',', ':'), allow_nan=False), qos=0)
+
+    # Publishes each field on its own topic.  This costs several publishes per
+    #  reading, so prefer publishMQTTJSON unless something needs the split topics
+    def publishMQTTIndividual(self, client):
+        # Several publishes per reading, so only look the method up once
+        publish = client.publish
+        publish(self._topic_temp_c, self.temp)
+        publish(self._topic_temp_f, round((self.temp * (9.0/5.0)) + 32, 1))
             
-        client.publish(tc + "/humidity", self.humidity)
+        publish(self._topic_humidity, self.humidity)
             
         if self.battery:
-            client.publish(tc + "/battery", "good")
+            publish(self._topic_battery, "good")
         else:
-            client.publish(tc + "/battery", "bad")
+            publish(self._topic_battery, "bad")
 
         if self.model == "Acurite-00275rm":
             # Temperature probes
-            client.publish(tc + "/ptemp_c", self.ptemp)
-            client.publish(tc + "/ptemp_f", round((self.ptemp * (9.0/5.0)) + 32, 1))
-
-def processInput(q):
-    print("Processing input!!")
-    while(True):
+            publish(self._topic_ptemp_c, self.ptemp)
+            publish(self._topic_ptemp_f, round((self.ptemp * (9.0/5.0)) + 32, 1))
+
+def processInput(lines):
+    # Turn complete lines of rtl_433 output into message dicts
+    messages = []
+    for line in lines:
+        if not line.strip():
+            continue
         try:
-            line = sys.stdin.readline()
-            q.put(line)
-        except KeyboardInterrupt as e:
-            print("Caught keyboard interrupt in readline")
-            break
-        
-            
+            data = json.loads(line)
+        except ValueError:
+            print("Could not parse input: " + line.decode(errors='replace').strip())
+            continue
+        if isinstance(data, dict):
+            messages.append(data)
+    return messages
+
+def _read_comm(pid):
+    # Processes can go away while we are scanning, so treat that as no name
+    try:
+        with open("/proc/{}/comm".format(pid), 'r') as comm:
+            return comm.read().rstrip()
+    except OSError:
+        return ""
+
 def main(configFile = "/etc/w2mqtt.conf"):
     mqtt_config = {}
 
     # We need to get the pid of the rtl process that is backing us
+    #  The wrapper starts us in the same pipeline, so rtl_433 may not have
+    #  started yet.  Keep looking for up to a second before giving up
     
     try:
-        sleep(1)
-        pids = list(map(int, check_output(["pidof","rtl_433"]).split()))
+        pids = []
+        deadline = time.time() + 1.0
+        while True:
+            pids = [int(p) for p in os.listdir("/proc")
+                    if p.isdigit() and _read_comm(p) == "rtl_433"]
+            if len(pids) > 0 or time.time() >= deadline:
+                break
+            sleep(0.05)
         if len(pids) == 0:
             print("Cannot find the trtl_433 process")
             return -1
-    except:
-        print("Failed to run pid program")
+    except OSError:
+        print("Failed to scan /proc for rtl_433")
         return -1
 
     print("Pid of program: {}", pids[0])
@@ -311,6 +362,10 @@ def main(configFile = "/etc/w2mqtt.conf"):
     else:
         print("Could not find config: " + configFile)
 
+    # None of this changes once we are running, so work it out up front
+    known_ids = frozenset(sensorNames)
+    base_topic = mqtt_config.get('topic', '')
+    unknown_topic_prefix = "unknown/weather/"
 
     # Connect to the mqtt server
     try:
@@ -323,36 +378,47 @@ def main(configFile = "/etc/w2mqtt.conf"):
         print("Could not open mqtt server")
         return -2
 
-    # Create a queue to get data from the input processing thread
-    inpq = SimpleQueue()
-    worker = Thread(target=processInput, args=(inpq,))
-    worker.daemon = True
-    sensors = SensorList(sensorNames)
+    # Watch stdin directly for output from rtl_433.  Plain select() rather
+    #  than epoll so a capture file redirected onto stdin works too
+    inpfd = sys.stdin.fileno()
+    pending = b""
+    sensors = SensorList(sensorNames, base_topic)
     
     lastInputTime = time.time()
-    ignored = []
+    ignored = OrderedDict()
     # And just sit here waiting for data
-    worker.start()
     while True:
+        # Block until there is input or the watchdog is due to fire
+        timeout = max(0.01, lastInputTime + 60 - time.time())
+        messages = []
+        readable, _, _ = select.select([inpfd], [], [], timeout)
+        if readable:
+            chunk = os.read(inpfd, 65536)
+            if chunk == b"":
+                print("Input closed")
+                break
+            # Hold on to any partial line until the rest of it shows up
+            lines = (pending + chunk).split(b"\n")
+            pending = lines.pop()
+            messages = processInput(lines)
+
         thisTime = time.time()
-        if not inpq.empty():
-            line = inpq.get()
-            data = json.loads(line)
-            if not 'id' in data:
+        for data in messages:
+            sid = data.get('id')
+            if sid is None:
                 continue
-            if data['id'] in ignored:
+            if sid in ignored:
                 continue
-            if not data['id'] in sensorNames:
-                ignored.append(data['id'])
-                mqttc.publish("unknown/weather/{}".format(data['id']))
+            if sid not in known_ids:
+                ignored[sid] = True
+                if len(ignored) > _MAX_IGNORED:
+                    ignored.popitem(last=False)
+                mqttc.publish(unknown_topic_prefix + str(sid), qos=0)
                 continue
             
             for sensor in sensors.process(data):
-                sensor.publishMQTTJSON(mqttc, mqtt_config['topic'])
+                sensor.publishMQTTJSON(mqttc)
                 lastInputTime = thisTime
-        else:
-            # Just wait a small bit of time for more data
-            sleep(0.1)
 
         if thisTime - lastInputTime > (60):
             # RTL 433 seems to have locked up.  The only way I have 
@@ -360,8 +426,8 @@ def main(configFile = "/etc/w2mqtt.conf"):
             #  SIGERM is not sufficient so send SIGKILL
             print(" **** rtl_433 seems to have frozen **** ")
             topic = "base/restart"
-            if len(mqtt_config['topic']) > 0:
-                topic = mqtt_config['topic'] + "/" + topic
+            if len(base_topic) > 0:
+                topic = base_topic + "/" + topic
             mqttc.publish(topic, 1)
             os.kill(pids[0], signal.SIGKILL)
             break